@@ -1,20 +1,131 @@
 """字体识别小工具 - 优化版"""
 import json
 import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from io import BytesIO
 from pathlib import Path
-from typing import Dict, Optional, Tuple
+from typing import Callable, Dict, List, Optional, Set, Tuple
 from fontTools.ttLib import TTFont
-from io import BytesIO
-from PIL import Image, ImageDraw, ImageFont, ImageFilter
+from PIL import Image, ImageDraw, ImageFont
 import ddddocr
+import onnxruntime
+
+try:
+    import orjson
+except ImportError:  # orjson为可选依赖，未安装时使用标准库json
+    orjson = None
+
+try:
+    from tqdm import tqdm
+except ImportError:  # tqdm为可选依赖，未安装时定期打印进度
+    tqdm = None
+
+# OCR批处理大小：每累积这么多字符图像提交一次识别
+OCR_BATCH_SIZE = 64
+# 未安装tqdm时，每处理这么多字符打印一次进度
+PROGRESS_INTERVAL = 100
+# 同时进行OCR推理的线程数（onnxruntime推理时会释放GIL）
+OCR_WORKERS = min(4, os.cpu_count() or 1)
+# 可用CUDA时OCR推理使用的GPU编号
+OCR_DEVICE_ID = 0
+# 同时渲染字符图像的线程数（PIL的二值化等像素操作会释放GIL）
+RENDER_WORKERS = min(4, os.cpu_count() or 1)
+# OCR阶段凑批时等待后续图像的最长时间（秒），避免渲染较慢时批次迟迟不提交
+OCR_MAX_WAIT = 0.05
+# 保存字符图像时使用的PNG压缩级别（0-9）
+PNG_COMPRESS_LEVEL = 1
+# 流水线各阶段之间队列的容量上限，防止某个阶段过快时占用过多内存
+PIPELINE_QUEUE_SIZE = 64
+# 流水线各阶段等待队列时检查是否已中止的间隔（秒）
+PIPELINE_POLL_INTERVAL = 0.1
+# 队列结束标记
+_STOP = object()
+# 处理结束后最多列出的出错字符数
+MAX_ERRORS_SHOWN = 20
+# 二值化查找表：灰度值小于128映射为黑色，其余为白色
+_BINARIZE_LUT = [0] * 128 + [255] * 128
+# 每个线程独立持有的绘图画布
+_canvas_local = threading.local()
+
+# 字体加载函数：字体大小 -> 字体对象
+FontLoader = Callable[[int], ImageFont.FreeTypeFont]
+
+
+def make_font_loader(font_bytes: bytes) -> FontLoader:
+    """
+    创建按字体大小缓存已加载字体的加载函数，避免每个字符重复解析TTF
 
+    缓存随加载函数一起释放，不会跨字体或跨调用保留
 
-def calculate_font_size(font_path: str, char: str, target_width: int, target_height: int) -> int:
+    Args:
+        font_bytes: 字体文件内容
+
+    Returns:
+        加载函数：字体大小 -> 字体对象
+    """
+    @lru_cache(maxsize=8)
+    def get_font(font_size: int) -> ImageFont.FreeTypeFont:
+        return ImageFont.truetype(BytesIO(font_bytes), font_size)
+
+    return get_font
+
+
+@lru_cache(maxsize=1)
+def _get_ocr() -> ddddocr.DdddOcr:
+    """
+    创建并缓存OCR引擎，多次处理字体时只加载一次模型
+
+    Returns:
+        OCR引擎对象
+    """
+    # 有CUDA时在GPU上推理；ddddocr会以元组形式显式指定CUDA提供者，并保留CPU兜底
+    use_gpu = 'CUDAExecutionProvider' in onnxruntime.get_available_providers()
+    ocr = ddddocr.DdddOcr(beta=True, show_ad=False, use_gpu=use_gpu, device_id=OCR_DEVICE_ID)
+
+    # 以会话实际使用的提供者为准：CUDA初始化失败（如缺少cuDNN）时会静默回退到CPU
+    providers = ocr.ocr_engine.session.get_providers()
+    on_gpu = 'CUDAExecutionProvider' in providers
+    print(f"OCR推理设备: {f'GPU {OCR_DEVICE_ID}' if on_gpu else 'CPU'} (providers: {', '.join(providers)})")
+    if use_gpu and not on_gpu:
+        print("警告: CUDA可用但初始化失败，OCR已回退到CPU推理")
+    return ocr
+
+
+def _get_canvas(width: int, height: int) -> Tuple[Image.Image, ImageDraw.ImageDraw]:
+    """
+    获取当前线程复用的灰度画布及其绘图对象，避免每个字符重新分配图像和ImageDraw
+
+    画布内容不会自动清空，使用者需要自行填充背景
+
+    Args:
+        width: 画布宽度
+        height: 画布高度
+
+    Returns:
+        (画布图像, 绘图对象)
+    """
+    canvases = getattr(_canvas_local, 'canvases', None)
+    if canvases is None:
+        canvases = _canvas_local.canvases = {}
+
+    canvas = canvases.get((width, height))
+    if canvas is None:
+        img = Image.new('L', (width, height), 255)
+        canvas = canvases[(width, height)] = (img, ImageDraw.Draw(img))
+    return canvas
+
+
+def calculate_font_size(get_font: FontLoader, char: str, target_width: int, target_height: int) -> int:
     """
     计算合适的字体大小，使字符适应目标尺寸
 
     Args:
-        font_path: 字体文件路径
+        get_font: 字体加载函数（由make_font_loader创建）
         char: 字符
         target_width: 目标宽度
         target_height: 目标高度
@@ -25,20 +136,16 @@ def calculate_font_size(font_path: str, char: str, target_width: int, target_hei
     # 初始字体大小设为高度的80%
     font_size = int(target_height * 0.8)
 
-    # 使用临时图像测试边界
-    temp_img = Image.new('L', (target_width, target_height), 255)
-    temp_draw = ImageDraw.Draw(temp_img)
-
     # 尝试调整字体大小直到字符适应
     for i in range(5):  # 最多尝试5次
         try:
-            font = ImageFont.truetype(font_path, font_size)
+            font = get_font(font_size)
         except:
             # 如果无法加载字体，返回默认大小
             return int(target_height * 0.6)
 
-        # 获取文本边界
-        bbox = temp_draw.textbbox((0, 0), char, font=font)
+        # 直接向字体查询字形边界，无需借助画布
+        bbox = font.getbbox(char)
         char_width = bbox[2] - bbox[0]
         char_height = bbox[3] - bbox[1]
 
@@ -51,18 +158,22 @@ def calculate_font_size(font_path: str, char: str, target_width: int, target_hei
         else:
             break
 
-    return max(20, min(font_size, target_height * 0.9))  # 确保在合理范围内
+    return int(max(20, min(font_size, target_height * 0.9)))  # 确保在合理范围内
 
 
-def convert_cmap_to_image(cmap_code: int, font_path: str,
-                         img_size: Tuple[int, int] = (64, 64)) -> Image.Image:
+def convert_cmap_to_image(cmap_code: int, get_font: FontLoader,
+                         img_size: Tuple[int, int] = (64, 64),
+                         font_size: Optional[int] = None,
+                         font_warnings: Optional[Set[str]] = None) -> Image.Image:
     """
     将字符转换为OCR友好的图像
 
     Args:
         cmap_code: Unicode码点
-        font_path: 字体文件路径
+        get_font: 字体加载函数（由make_font_loader创建）
         img_size: 图像大小 (宽, 高)
+        font_size: 字体大小（如果为None则针对该字符单独计算）
+        font_warnings: 字体加载警告集合（如果提供，警告加入集合而不是直接打印，相同警告只记录一次）
 
     Returns:
         包含字符的图像对象
@@ -71,26 +182,32 @@ def convert_cmap_to_image(cmap_code: int, font_path: str,
     character = chr(cmap_code)  # 将 cmap code 转换为字符
 
     # 使用灰度图像，白色背景，黑色文字 - OCR对此格式识别最好
-    img = Image.new('L', (width, height), 255)  # 'L'模式是8位灰度，255是白色
-    draw = ImageDraw.Draw(img)
+    # 复用线程内的画布，先用白色（255）清空上一个字符
+    img, draw = _get_canvas(width, height)
+    draw.rectangle((0, 0, width, height), fill=255)
 
     try:
         # 计算合适的字体大小
-        font_size = calculate_font_size(font_path, character, width, height)
-        font = ImageFont.truetype(font_path, font_size)
+        if font_size is None:
+            font_size = calculate_font_size(get_font, character, width, height)
+        font = get_font(font_size)
     except Exception as e:
-        print(f"加载字体失败，使用默认字体: {e}")
+        message = f"加载字体失败，使用默认字体: {e}"
+        if font_warnings is None:
+            print(message)
+        else:
+            font_warnings.add(message)
         # 如果无法加载字体，使用默认字体
         font_size = int(height * 0.6)
         try:
             # 尝试加载系统默认字体
-            font = ImageFont.truetype(font_path, font_size)
+            font = get_font(font_size)
         except:
             # 最后使用PIL默认字体
             font = ImageFont.load_default()
 
-    # 获取文本边界
-    bbox = draw.textbbox((0, 0), character, font=font)
+    # 获取文本边界（与draw.textbbox((0, 0), ...)结果相同，但省去ImageDraw的参数处理）
+    bbox = font.getbbox(character)
     char_width = bbox[2] - bbox[0]
     char_height = bbox[3] - bbox[1]
 
@@ -101,20 +218,15 @@ def convert_cmap_to_image(cmap_code: int, font_path: str,
     # 绘制文本（黑色）
     draw.text((x, y), character, font=font, fill=0)  # 0是黑色
 
-    # 对图像进行轻微锐化，提高OCR识别率
-    img = img.filter(ImageFilter.SHARPEN)
-
-    # 转换为二值图像（黑白），进一步提高对比度
-    img = img.point(lambda x: 0 if x < 128 else 255, '1')
-
-    # 转换回灰度图像（因为ddddocr可能对灰度图像识别更好）
-    img = img.convert('L')
-
-    return img
+    # 二值化（黑白）提高对比度，结果仍为灰度图像（ddddocr对灰度图像识别更好）
+    # 二值化前不再锐化：固定阈值只改变极少数边缘像素，对识别结果没有实质帮助
+    # point返回新图像，画布可继续复用
+    return img.point(_BINARIZE_LUT)
 
 
 def save_character_image(image: Image.Image, save_dir: Path,
-                        glyph_name: str, cmap_code: int) -> str:
+                        glyph_name: str, cmap_code: int,
+                        existing_files: Optional[Set[str]] = None) -> str:
     """
     保存字符图像到指定目录
 
@@ -123,12 +235,15 @@ def save_character_image(image: Image.Image, save_dir: Path,
         save_dir: 保存目录
         glyph_name: 字形名称
         cmap_code: Unicode码点
+        existing_files: 保存目录中已有的文件名集合（如果提供，则在内存中检查重名并
+            记录新文件，调用方需确保目录已存在；为None时逐个检查磁盘）
 
     Returns:
         保存的文件名
     """
     # 创建保存目录（如果不存在）
-    save_dir.mkdir(parents=True, exist_ok=True)
+    if existing_files is None:
+        save_dir.mkdir(parents=True, exist_ok=True)
 
     # 生成安全的文件名
     hex_code = f"{cmap_code:04x}"
@@ -142,13 +257,20 @@ def save_character_image(image: Image.Image, save_dir: Path,
     # 确保文件名不重复
     counter = 1
     original_filename = safe_filename
-    while (save_dir / f"{safe_filename}.png").exists():
-        safe_filename = f"{original_filename}_{counter}"
-        counter += 1
-
-    # 保存图像为PNG格式
+    if existing_files is None:
+        while (save_dir / f"{safe_filename}.png").exists():
+            safe_filename = f"{original_filename}_{counter}"
+            counter += 1
+    else:
+        while f"{safe_filename}.png" in existing_files:
+            safe_filename = f"{original_filename}_{counter}"
+            counter += 1
+
+    # 保存图像为PNG格式（二值小图用低压缩级别即可，默认级别6明显更慢）
     filename = f"{safe_filename}.png"
-    image.save(save_dir / filename, "PNG")
+    image.save(save_dir / filename, "PNG", compress_level=PNG_COMPRESS_LEVEL)
+    if existing_files is not None:
+        existing_files.add(filename)
 
     return filename
 
@@ -174,7 +296,9 @@ def extract_text_from_font(font_path: str, save_images: bool = False,
         return {}
 
     try:
-        font = TTFont(font_path)  # 加载字体文件
+        # 每次调用都重新读取字体文件，TTFont与各字号的PIL字体共用这一份数据
+        font_bytes = Path(font_path).read_bytes()
+        font = TTFont(BytesIO(font_bytes))  # 加载字体文件
     except Exception as e:
         print(f"加载字体文件失败: {e}")
         return {}
@@ -182,8 +306,7 @@ def extract_text_from_font(font_path: str, save_images: bool = False,
     # 初始化OCR
     print("初始化OCR引擎...")
     try:
-        # 使用默认配置，确保兼容性
-        ocr = ddddocr.DdddOcr(beta=True, show_ad=False)
+        ocr = _get_ocr()
     except Exception as e:
         print(f"初始化OCR失败: {e}")
         return {}
@@ -198,6 +321,7 @@ def extract_text_from_font(font_path: str, save_images: bool = False,
     print(f"发现 {len(cmap)} 个字符")
 
     # 设置图像保存目录
+    existing_files: Set[str] = set()
     if save_images:
         if image_dir is None:
             # 默认保存到字体文件同目录下的images文件夹
@@ -208,46 +332,187 @@ def extract_text_from_font(font_path: str, save_images: bool = False,
 
         print(f"字符图像将保存到: {image_dir.absolute()}")
 
-    processed = 0
-    successful = 0
-
-    for cmap_code, glyph_name in cmap.items():
-        try:
-            # 转换字符为图像（使用64x64大小，适合OCR识别）
-            image = convert_cmap_to_image(cmap_code, font_path, img_size=(64, 64))
-
-            # 保存图像（如果需要）
-            image_filename = None
-            if save_images and image_dir:
-                image_filename = save_character_image(image, image_dir, glyph_name, cmap_code)
-
-            # 使用OCR识别图像
-            bytes_io = BytesIO()
-            image.save(bytes_io, "PNG")
-            bytes_io.seek(0)  # 重置指针到开始位置
+        # 一次性读取目录中已有的文件名，保存时在内存中检查重名，避免逐个stat
+        image_dir.mkdir(parents=True, exist_ok=True)
+        existing_files = {entry.name for entry in image_dir.iterdir()}
 
-            # OCR识别
-            text = ocr.classification(bytes_io.getvalue())
-
-            # 保存映射关系
-            font_map[glyph_name] = {
-                "text": text,
-                "unicode": f"U+{cmap_code:04X}",
-                "code_point": cmap_code,
-                "hex": f"{cmap_code:04x}",
-                "image_file": image_filename
-            }
-
-            successful += 1
+    # 字体大小只用一个有代表性的字符计算一次，而不是每个字符都重新搜索
+    sample_code = next((code for code in cmap if not chr(code).isspace()), next(iter(cmap)))
+    # 字体缓存只属于本次调用，随get_font一起释放
+    get_font = make_font_loader(font_bytes)
+    font_size = calculate_font_size(get_font, chr(sample_code), 64, 64)
 
+    render_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    write_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    successful = 0
+    # 已识别图像的缓存：图像像素数据 -> 识别结果
+    ocr_cache: Dict[bytes, str] = {}
+    # 出错信息先收集起来，处理结束后统一输出，避免打断进度条
+    errors: List[str] = []
+    font_warnings: Set[str] = set()
+    progress = tqdm(total=len(cmap), desc="识别字符", unit="字") if tqdm is not None else None
+    # 任一阶段异常终止时置位，其余阶段不再阻塞在队列上，随之退出
+    abort = threading.Event()
+    stage_failures: List[str] = []
+
+    def put(q: queue.Queue, item) -> None:
+        """放入队列；流水线中止后直接放弃，避免阻塞在无人消费的满队列上"""
+        while not abort.is_set():
+            try:
+                q.put(item, timeout=PIPELINE_POLL_INTERVAL)
+                return
+            except queue.Full:
+                pass
+
+    def get(q: queue.Queue):
+        """从队列取出；流水线中止后返回结束标记，避免等待已终止的上游"""
+        while not abort.is_set():
+            try:
+                return q.get(timeout=PIPELINE_POLL_INTERVAL)
+            except queue.Empty:
+                pass
+        return _STOP
+
+    def run_stage(stage):
+        """运行一个阶段，异常时记录失败并中止整条流水线"""
+        try:
+            stage()
         except Exception as e:
-            print(f"处理字符 {glyph_name} (U+{cmap_code:04X}) 时出错: {e}")
+            stage_failures.append(f"{stage.__name__} 异常终止: {e!r}")
+            abort.set()
+
+    def render_stage():
+        """阶段A：多线程渲染字符图像，按码表顺序交给OCR阶段"""
+        def forward(cmap_code, glyph_name, future):
+            try:
+                image = future.result()
+            except Exception as e:
+                errors.append(f"处理字符 {glyph_name} (U+{cmap_code:04X}) 时出错: {e}")
+                # 渲染失败的字符也继续向后传递（图像为None），以便写入阶段计入进度
+                image = None
+            put(render_queue, (cmap_code, glyph_name, image))
+
+        try:
+            with ThreadPoolExecutor(max_workers=RENDER_WORKERS) as executor:
+                # 限制同时在途的渲染任务数量，避免一次性渲染整个码表占满内存
+                pending = deque()
+                for cmap_code, glyph_name in cmap.items():
+                    if abort.is_set():
+                        break
+                    # 转换字符为图像（使用64x64大小，适合OCR识别）
+                    future = executor.submit(convert_cmap_to_image, cmap_code, get_font,
+                                             img_size=(64, 64), font_size=font_size,
+                                             font_warnings=font_warnings)
+                    pending.append((cmap_code, glyph_name, future))
+                    if len(pending) >= RENDER_WORKERS * 2:
+                        forward(*pending.popleft())
+                while pending:
+                    forward(*pending.popleft())
+        finally:
+            put(render_queue, _STOP)
+
+    def ocr_stage():
+        """阶段B：攒够一批或等待超时后批量识别，结果交给写入阶段"""
+        # ddddocr自带模型的batch维固定为1，无法把多张图像堆叠成一次推理，
+        # 因此按批提交到线程池，让各图像的推理重叠执行
+        try:
+            with ThreadPoolExecutor(max_workers=OCR_WORKERS) as executor:
+                finished = False
+                while not finished:
+                    # 阻塞等待批次的第一张图像，之后最多再等待OCR_MAX_WAIT秒
+                    item = get(render_queue)
+                    if item is _STOP:
+                        break
+                    batch = [item]
+                    deadline = time.monotonic() + OCR_MAX_WAIT
+                    while len(batch) < OCR_BATCH_SIZE:
+                        try:
+                            item = render_queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                        except queue.Empty:
+                            break
+                        if item is _STOP:
+                            finished = True
+                            break
+                        batch.append(item)
+
+                    # OCR批量识别（直接传入PIL图像，省去PNG编码再解码的开销）
+                    # 以像素数据为键去重：不同码点常复用同一字形，相同图像只识别一次
+                    keys = [image.tobytes() if image is not None else None for *_, image in batch]
+                    futures = {}
+                    for (*_, image), key in zip(batch, keys):
+                        if key is not None and key not in ocr_cache and key not in futures:
+                            futures[key] = executor.submit(ocr.classification, image)
+
+                    for (code, name, image), key in zip(batch, keys):
+                        if key is None:
+                            put(write_queue, (code, name, None, None))
+                            continue
+                        if key not in ocr_cache:
+                            try:
+                                ocr_cache[key] = futures[key].result()
+                            except Exception as e:
+                                errors.append(f"识别字符 {name} (U+{code:04X}) 时出错: {e}")
+                        put(write_queue, (code, name, image, ocr_cache.get(key)))
+        finally:
+            put(write_queue, _STOP)
+
+    def write_stage():
+        """阶段C：保存字符图像（如果需要）并记录映射关系"""
+        nonlocal successful
+        processed = 0
+        while (item := get(write_queue)) is not _STOP:
+            code, name, image, text = item
+            processed += 1
+            try:
+                # 保存图像（如果需要）
+                image_filename = None
+                if save_images and image_dir and image is not None:
+                    image_filename = save_character_image(image, image_dir, name, code, existing_files)
+
+                if text is not None:
+                    # 保存映射关系
+                    font_map[name] = {
+                        "text": text,
+                        "unicode": f"U+{code:04X}",
+                        "code_point": code,
+                        "hex": f"{code:04x}",
+                        "image_file": image_filename
+                    }
+                    successful += 1
+            except Exception as e:
+                errors.append(f"保存字符 {name} (U+{code:04X}) 时出错: {e}")
+
+            # 显示进度（tqdm自带刷新频率限制）
+            if progress is not None:
+                progress.set_postfix(成功=successful, refresh=False)
+                progress.update()
+            elif processed % PROGRESS_INTERVAL == 0 or processed == len(cmap):
+                print(f"进度: {processed}/{len(cmap)} 字符，成功识别: {successful}")
+
+    # 渲染、识别、写盘三个阶段通过有界队列衔接，各自在独立线程中并行执行
+    stages = [threading.Thread(target=run_stage, args=(stage,), name=stage.__name__, daemon=True)
+              for stage in (render_stage, ocr_stage, write_stage)]
+    for stage in stages:
+        stage.start()
+    for stage in stages:
+        stage.join()
+    if progress is not None:
+        progress.close()
+
+    if stage_failures:
+        for message in stage_failures:
+            print(f"处理中断: {message}")
+        return {}
 
-        processed += 1
+    for message in sorted(font_warnings):
+        print(message)
 
-        # 显示进度
-        if processed % 100 == 0 or processed == len(cmap):
-            print(f"进度: {processed}/{len(cmap)} 字符，成功识别: {successful}")
+    if errors:
+        print(f"共 {len(errors)} 个字符处理出错:")
+        for message in errors[:MAX_ERRORS_SHOWN]:
+            print(f"  {message}")
+        if len(errors) > MAX_ERRORS_SHOWN:
+            print(f"  ……其余 {len(errors) - MAX_ERRORS_SHOWN} 条省略")
 
     print(f"处理完成！成功处理 {successful}/{len(cmap)} 个字符")
 
@@ -264,8 +529,12 @@ def save_font_map(font_map: Dict, output_path: str, indent: int = 2):
         indent: JSON缩进
     """
     try:
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(font_map, f, ensure_ascii=False, indent=indent)
+        if orjson is not None and indent == 2:
+            # orjson直接输出UTF-8字节，比标准库json带缩进序列化快得多（仅支持2空格缩进）
+            data = orjson.dumps(font_map, option=orjson.OPT_INDENT_2)
+        else:
+            data = json.dumps(font_map, ensure_ascii=False, indent=indent).encode('utf-8')
+        Path(output_path).write_bytes(data)
         print(f"字体映射已保存到: {output_path}")
     except Exception as e:
         print(f"保存字体映射失败: {e}")
@@ -3,12 +3,21 @@
 智能包安装工具 - 自动使用国内镜像源
 """
 
+import json
 import subprocess
 import sys
+import threading
 import time
 import requests
 import os
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+
+# 最快镜像源测速结果的缓存文件及有效期（秒），有效期内不再重复测速
+MIRROR_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'smart_install', 'fastest.json')
+MIRROR_CACHE_TTL = 3600
+
+
 class SmartInstaller:
     def __init__(self):
         # 国内常用镜像源
@@ -23,8 +32,11 @@ class SmartInstaller:
             '官方源': 'https://pypi.org/simple'
         }
 
-        # 默认选中的镜像源（按优先级排序）
-        self.default_mirrors = ['清华', '阿里云', '腾讯云', '豆瓣']
+        # 各镜像源地址对应的主机名（用于--trusted-host），初始化时解析一次
+        self.mirror_hosts = {url: urlparse(url).netloc for url in self.mirrors.values()}
+
+        # 最近一次测速中可用的镜像源，按速度排序 [(名称, 地址, 耗时ms)]，尚未测速时为None
+        self.ranked_mirrors = None
 
     def test_mirror_speed(self, mirror_name, mirror_url):
         """测试镜像源响应速度"""
@@ -35,8 +47,8 @@ class SmartInstaller:
             if not test_url.endswith('/'):
                 test_url += '/'
 
-            # 设置超时和重试
-            response = requests.get(test_url, timeout=3)
+            # 只发HEAD请求，不下载首页内容
+            response = requests.head(test_url, timeout=3, allow_redirects=True)
             response_time = (time.time() - start_time) * 1000  # 毫秒
 
             if response.status_code == 200:
@@ -47,23 +59,48 @@ class SmartInstaller:
             print(f"  镜像源 {mirror_name} 测试失败: {str(e)[:50]}...")
             return mirror_name, mirror_url, float('inf'), False
 
-    def find_fastest_mirror(self, manual_mirror=None):
-        """寻找最快的镜像源"""
-        if manual_mirror and manual_mirror in self.mirrors:
-            print(f"🔧 使用指定镜像源: {manual_mirror}")
-            return manual_mirror, self.mirrors[manual_mirror]
+    def load_cached_ranking(self):
+        """读取未过期的镜像源测速排名缓存，没有则返回None"""
+        try:
+            with open(MIRROR_CACHE_FILE, 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+            if time.time() - cache['time'] >= MIRROR_CACHE_TTL:
+                return None
+            return [(name, self.mirrors[name], speed)
+                    for name, speed in cache['ranked'] if name in self.mirrors]
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def save_cached_ranking(self, ranked):
+        """缓存镜像源测速排名"""
+        try:
+            os.makedirs(os.path.dirname(MIRROR_CACHE_FILE), exist_ok=True)
+            with open(MIRROR_CACHE_FILE, 'w', encoding='utf-8') as f:
+                json.dump({'ranked': [[name, speed] for name, _, speed in ranked], 'time': time.time()},
+                          f, ensure_ascii=False)
+        except OSError:
+            pass
+
+    def rank_mirrors(self, use_cache=True):
+        """测试所有镜像源，返回可用镜像源按速度排序的列表 [(名称, 地址, 耗时ms)]"""
+        if use_cache:
+            cached = self.load_cached_ranking()
+            if cached:
+                print("⚡ 使用缓存的镜像源测速结果")
+                self.ranked_mirrors = cached
+                return cached
 
         print("🔍 正在测试镜像源速度...")
 
         results = []
-        with ThreadPoolExecutor(max_workers=len(self.default_mirrors)) as executor:
-            # 提交所有测试任务
+        with ThreadPoolExecutor(max_workers=len(self.mirrors)) as executor:
+            # 同时测试所有镜像源，总耗时取决于最慢的一个而不是所有之和
             future_to_mirror = {
                 executor.submit(
                     self.test_mirror_speed,
                     name,
-                    self.mirrors[name]
-                ): name for name in self.default_mirrors
+                    url
+                ): name for name, url in self.mirrors.items()
             }
 
             # 收集结果
@@ -75,17 +112,37 @@ class SmartInstaller:
                 else:
                     print(f"  ✗ {name}: 不可用")
 
+        # 按速度排序
+        results.sort(key=lambda x: x[2])
+        self.ranked_mirrors = results
+        if results:
+            self.save_cached_ranking(results)
+        return results
+
+    def find_fastest_mirror(self, manual_mirror=None, use_cache=True):
+        """寻找最快的镜像源"""
+        if manual_mirror and manual_mirror in self.mirrors:
+            print(f"🔧 使用指定镜像源: {manual_mirror}")
+            return manual_mirror, self.mirrors[manual_mirror]
+
+        results = self.rank_mirrors(use_cache)
+
         if not results:
             print("⚠️  所有镜像源都不可用，使用官方源")
             return '官方源', self.mirrors['官方源']
 
-        # 按速度排序
-        results.sort(key=lambda x: x[2])
         fastest = results[0]
         print(f"\n🚀 选择最快镜像源: {fastest[0]} ({fastest[2]:.0f}ms)")
         return fastest[0], fastest[1]
 
-    def build_pip_command(self, mirror_url, package_name=None, upgrade=False, requirements_file=None):
+    def get_mirror_host(self, mirror_url):
+        """获取镜像源地址的主机名，优先使用预先解析的结果"""
+        mirror_host = self.mirror_hosts.get(mirror_url)
+        if mirror_host is None:
+            mirror_host = urlparse(mirror_url).netloc
+        return mirror_host
+
+    def build_pip_command(self, mirror_url, package_names=None, upgrade=False, requirements_file=None):
         """构建pip命令"""
         pip_cmd = [sys.executable, '-m', 'pip', 'install']
 
@@ -93,56 +150,74 @@ class SmartInstaller:
             pip_cmd.append('--upgrade')
 
         # 添加镜像源
-        mirror_host = mirror_url.split('//')[1].split('/')[0]
+        mirror_host = self.get_mirror_host(mirror_url)
         pip_cmd.extend(['-i', mirror_url, '--trusted-host', mirror_host])
 
         # 添加包名或requirements文件
         if requirements_file:
             pip_cmd.extend(['-r', requirements_file])
-        elif package_name:
-            pip_cmd.append(package_name)
+        elif package_names:
+            pip_cmd.extend(package_names)
 
         return pip_cmd
 
-    def install_package(self, package_name=None, upgrade=False, requirements_file=None, mirror=None):
-        """安装包"""
+    def run_pip(self, pip_cmd):
+        """执行pip命令并实时输出stdout，失败时抛出带stderr内容的CalledProcessError"""
+        stderr_lines = []
+        with subprocess.Popen(pip_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              text=True, encoding='utf-8', errors='replace', bufsize=1) as process:
+            # 在后台线程中收集stderr，避免其管道写满后阻塞pip
+            reader = threading.Thread(target=lambda: stderr_lines.extend(process.stderr))
+            reader.start()
+            for line in process.stdout:
+                sys.stdout.write(line)
+            reader.join()
+
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, pip_cmd, stderr=''.join(stderr_lines))
+
+    def install_package(self, package_names=None, upgrade=False, requirements_file=None, mirror=None):
+        """安装包（多个包在同一次pip调用中一起安装，依赖只解析一次）"""
         # 查找最快镜像源
         mirror_name, mirror_url = self.find_fastest_mirror(mirror)
 
         if requirements_file:
             print(f"\n📦 从 {requirements_file} 安装依赖包...")
         else:
-            print(f"\n📦 安装包: {package_name}...")
+            print(f"\n📦 安装包: {' '.join(package_names)}...")
 
         print(f"🌐 使用镜像: {mirror_name} ({mirror_url})")
 
         # 构建pip命令
-        pip_cmd = self.build_pip_command(mirror_url, package_name, upgrade, requirements_file)
+        pip_cmd = self.build_pip_command(mirror_url, package_names, upgrade, requirements_file)
         print(f"🔧 执行命令: {' '.join(pip_cmd)}\n")
 
         # 执行安装
         try:
-            result = subprocess.run(pip_cmd, check=True, capture_output=True, text=True, encoding='utf-8')
+            self.run_pip(pip_cmd)
             print("✅ 安装成功！")
-            if result.stdout:
-                print(result.stdout)
             return True
         except subprocess.CalledProcessError as e:
             print("❌ 安装失败！")
             if e.stderr:
                 print(f"错误信息:\n{e.stderr}")
 
-            # 尝试使用备用镜像源
+            # 尝试使用备用镜像源：只按测速排名尝试可用的镜像源，跳过已知不可用的
             print("\n🔄 尝试使用备用镜像源...")
-            for name, url in self.mirrors.items():
+            ranked = self.ranked_mirrors if self.ranked_mirrors is not None else self.rank_mirrors()
+            for name, url, _ in ranked:
                 if name != mirror_name:
                     print(f"  尝试: {name}")
-                    pip_cmd = self.build_pip_command(url, package_name, upgrade, requirements_file)
+                    pip_cmd = self.build_pip_command(url, package_names, upgrade, requirements_file)
                     try:
-                        subprocess.run(pip_cmd, check=True)
+                        self.run_pip(pip_cmd)
                         print(f"✅ 使用 {name} 安装成功！")
                         return True
-                    except:
+                    except subprocess.CalledProcessError as e:
+                        if e.stderr:
+                            print(f"  错误信息:\n{e.stderr}")
+                        continue
+                    except OSError:
                         continue
 
             print("💥 所有镜像源都失败，请检查网络或包名")
@@ -173,7 +248,7 @@ class SmartInstaller:
         print(f"   镜像地址: {mirror_url}")
 
         # 创建pip配置文件内容
-        mirror_host = mirror_url.split('//')[1].split('/')[0]
+        mirror_host = self.get_mirror_host(mirror_url)
         config_content = f"""[global]
 index-url = {mirror_url}
 trusted-host = {mirror_host}
@@ -264,7 +339,7 @@ def main():
                 installer.set_persistent_mirror()
             return
         elif arg == '--test':
-            installer.find_fastest_mirror()
+            installer.find_fastest_mirror(use_cache=False)
             return
         elif arg == '--upgrade':
             upgrade = True
@@ -285,7 +360,6 @@ def main():
                 return
         elif not arg.startswith('-'):
             # 安装包
-            package = arg
             # 检查是否还有更多包
             packages = [arg]
             i += 1
@@ -293,13 +367,12 @@ def main():
                 packages.append(args[i])
                 i += 1
 
-            # 安装所有包
-            for pkg in packages:
-                installer.install_package(
-                    package_name=pkg,
-                    upgrade=upgrade,
-                    mirror=mirror
-                )
+            # 所有包通过一次pip调用安装
+            installer.install_package(
+                package_names=packages,
+                upgrade=upgrade,
+                mirror=mirror
+            )
             return
 
         i += 1